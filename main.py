@@ -14,41 +14,55 @@
 """
 
 import os
-import sys
 import json
+import queue
+import atexit
 import time
-import uuid
-import base64
 import logging
-import traceback
 import sqlite3
 import threading
 import asyncio
 import random
+import re
 import hashlib
-from datetime import datetime, timedelta
+import itertools
+import math
+import string
+import importlib.util
+import weakref
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
-from urllib.parse import quote, unquote
 
-import requests
 import httpx
-from functools import wraps
+from functools import wraps, lru_cache
 
 from flask import (
-    Flask, request, jsonify, render_template, render_template_string,
-    session, redirect, url_for, flash, send_from_directory, make_response
+    Flask, request, render_template, session, redirect, url_for, flash
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, bindparam
+from sqlalchemy.engine import Engine, make_url
 
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
 
 # Telegram Bot imports
-from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+
+# Optional faster event loop for the bot thread
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Optional faster JSON encoder for log records
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # =========================
 # ENVIRONMENT & CONFIG
@@ -66,15 +80,21 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 ADMIN_USER = os.getenv("ADMIN_USER", "Admin")
 ADMIN_PASS = os.getenv("ADMIN_PASS", "12345")
 ADMIN_ID = os.getenv("ADMIN_ID", "6646320334")
+# Telegram user ids allowed to run admin commands (ADMIN_ID may list several, comma-separated)
+ADMIN_IDS = frozenset(x.strip() for x in ADMIN_ID.split(",") if x.strip())
 
 # Database Configuration
 DB_URL = os.getenv("DB_URL", "sqlite:///data.db")
 SQLITE_PATH = os.getenv("SQLITE_PATH", "app.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
 
 # API Keys
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_TIMEOUT = int(os.getenv("OPENAI_TIMEOUT", "60"))
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None  # httpx[http2] installed
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "3600"))     # seconds a cached answer stays valid
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "2048"))   # max cached prompts
 
 HF_API_URL = os.getenv("HUGGINGFACE_API_URL")
 HF_API_TOKEN = os.getenv("HUGGINGFACE_API_TOKEN")
@@ -83,6 +103,22 @@ HF_API_TOKEN = os.getenv("HUGGINGFACE_API_TOKEN")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_POLLING = os.getenv("TELEGRAM_POLLING", "true").lower() == "true"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Sent by Telegram as X-Telegram-Bot-Api-Secret-Token; the fallback is derived from the
+# bot token so every worker process agrees on it
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(
+    f"webhook:{TELEGRAM_TOKEN or ''}".encode()
+).hexdigest()
+TELEGRAM_PORT = int(os.getenv("TELEGRAM_PORT", "8443"))
+TELEGRAM_WEBHOOK_PATH = "telegram_webhook"
+TELEGRAM_WEBHOOK_URL = f"{DOMAIN}/{TELEGRAM_WEBHOOK_PATH}"  # registered URL and served path must agree
+# Discard updates queued while the bot was down instead of replaying a stale backlog
+TELEGRAM_DROP_PENDING_UPDATES = os.getenv("TELEGRAM_DROP_PENDING_UPDATES", "true").lower() == "true"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "20"))  # concurrent Telegram deliveries (1-100)
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "50"))  # long-poll seconds per getUpdates
+# Keep-alive connections to the Bot API; never below the 256 concurrent updates
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "256"))
+TELEGRAM_TOKEN_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+TELEGRAM_USERNAME = TELEGRAM_TOKEN.partition(':')[0] if TELEGRAM_TOKEN else 'ganeshaibot'
 
 # Payment Gateway Configuration
 CASHFREE_CLIENT_ID = os.getenv("CASHFREE_CLIENT_ID")
@@ -135,17 +171,44 @@ logging.basicConfig(
 )
 logger = logging.getLogger(APP_NAME)
 
+# The format above never shows thread/process/task fields, so skip collecting them per record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging.logAsyncioTasks = False
+
+# Compact encoder built once instead of per log call
+if orjson:
+    def encode_json(obj) -> str:
+        return orjson.dumps(obj).decode()
+else:
+    encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+# (epoch second, formatted stamp) for the last second now_ts() formatted
+_now_cache = (0, "")
+
+def now_ts() -> str:
+    """Current UTC time as an ISO-8601 timestamp, formatted at most once per second"""
+    global _now_cache
+    second = int(time.time())
+    if second != _now_cache[0]:
+        _now_cache = (second, datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return _now_cache[1]
+
 def log(section: str, level: str, message: str, extra: Dict = None):
     """Enhanced logging function"""
+    log_level = getattr(logging, level.upper(), logging.INFO)
+    if not logger.isEnabledFor(log_level):
+        return  # skip building and serializing records that would be dropped
+    
     log_data = {
         "section": section,
         "msg": message,
         "extra": extra or {},
-        "time": datetime.now(datetime.timezone.utc).isoformat()
+        "time": now_ts()
     }
     
-    log_level = getattr(logging, level.upper(), logging.INFO)
-    logger.log(log_level, json.dumps(log_data))
+    logger.log(log_level, encode_json(log_data))
 
 # =========================
 # FLASK APP SETUP
@@ -155,17 +218,64 @@ app = Flask(__name__)
 app.secret_key = FLASK_SECRET
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
+@lru_cache(maxsize=None)
+def compile_page(source: str):
+    """Compile an inline page template once per process"""
+    return app.jinja_env.from_string(source)
+
+def render_page(source: str, **context) -> str:
+    """render_template_string without re-parsing the template on every request"""
+    return render_template(compile_page(source), **context)
+
 # Database setup
 app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+db_url = make_url(DB_URL)
+if not (db_url.get_backend_name() == 'sqlite'
+        and (db_url.database in (None, '', ':memory:') or 'mode=memory' in DB_URL)):
+    # Enough pooled connections for every gunicorn thread plus the visit
+    # writer and Telegram loop, so WAL readers never wait behind the writer.
+    # In-memory SQLite uses a StaticPool, which takes no sizing options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+if DB_URL.startswith('sqlite'):
+    # Pooled connections keep their prepared statements; make the cache big
+    # enough to hold every statement the app issues
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'cached_statements': 256}
 db = SQLAlchemy(app)
 
+# SQLite connection tuning - SQLAlchemy keeps connections in its pool, so
+# these PRAGMAs run once per connection instead of once per query
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA wal_autocheckpoint=1000",
+    "PRAGMA journal_size_limit=67108864",
+)
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply performance PRAGMAs to every new pooled SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 # =========================
 # DATABASE MODELS
 # =========================
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('idx_users_role', 'role'),  # admin lookup on every visit/earning
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -236,6 +346,9 @@ class User(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        db.Index('idx_transactions_user_created', 'user_id', 'created_at'),  # dashboard history
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -249,6 +362,9 @@ class Transaction(db.Model):
 
 class APIUsage(db.Model):
     __tablename__ = 'api_usage'
+    __table_args__ = (
+        db.Index('idx_api_usage_user_created', 'user_id', 'created_at'),  # dashboard history
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
@@ -336,8 +452,8 @@ def admin_required(f):
             flash('Please log in to access this page.', 'error')
             return redirect(url_for('login'))
         
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'admin':
+        role = db.session.query(User.role).filter_by(id=session['user_id']).scalar()
+        if role != 'admin':
             flash('Admin access required.', 'error')
             return redirect(url_for('dashboard'))
         
@@ -351,7 +467,18 @@ def admin_required(f):
 class AIModelManager:
     """Advanced AI Model Manager with multiple providers"""
     
+    # Canned replies for the free model when no Hugging Face endpoint is configured
+    FALLBACK_TEMPLATES = (
+        "Hello! I'm Ganesh AI. You asked: '{prompt}...' - I'm here to help you with any questions!",
+        "Thanks for using Ganesh AI! Regarding '{prompt}...', I'd be happy to assist you further.",
+        "Great question about '{prompt}...'! As Ganesh AI, I'm designed to provide helpful responses.",
+    )
+    
     def __init__(self):
+        self._http_clients = weakref.WeakKeyDictionary()
+        self._response_cache: Dict[str, tuple] = {}  # key -> (stored_at, content)
+        self._cache_lock = threading.Lock()
+        self._fallback_templates = itertools.cycle(self.FALLBACK_TEMPLATES)  # round-robin, no RNG
         self.models = {
             'gpt4': {
                 'name': 'GPT-4 Turbo',
@@ -390,11 +517,54 @@ class AIModelManager:
             }
         }
     
+    def _http_client(self) -> httpx.AsyncClient:
+        """Shared keep-alive client for the running event loop"""
+        # httpx connections are bound to the loop that opened them, and this
+        # manager is used from both Flask threads and the Telegram loop
+        loop = asyncio.get_running_loop()
+        client = self._http_clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+            self._http_clients[loop] = client
+        return client
+    
+    @staticmethod
+    def _cache_key(model_id: str, prompt: str) -> str:
+        """Exact-match cache key for a model/prompt pair"""
+        return hashlib.sha1(f"{model_id}\0{prompt}".encode()).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a cached response if present and not older than AI_CACHE_TTL"""
+        with self._cache_lock:
+            entry = self._response_cache.get(key)
+            if entry is None:
+                return None
+            stored_at, content = entry
+            if time.monotonic() - stored_at > AI_CACHE_TTL:
+                del self._response_cache[key]
+                return None
+            # Move to the newest end so eviction drops the least recently used
+            self._response_cache[key] = self._response_cache.pop(key)
+        return {'success': True, 'content': content}
+    
+    def _cache_put(self, key: str, content: str):
+        """Store a response, evicting the least recently used entries beyond AI_CACHE_SIZE"""
+        with self._cache_lock:
+            self._response_cache.pop(key, None)
+            self._response_cache[key] = (time.monotonic(), content)
+            while len(self._response_cache) > AI_CACHE_SIZE:
+                del self._response_cache[next(iter(self._response_cache))]
+    
     def get_available_models(self, user=None):
         """Get available models based on user subscription"""
         available = []
+        premium = bool(user and user.is_premium())  # once per call, not once per model
         for key, model in self.models.items():
-            if user and user.is_premium():
+            if premium:
                 available.append({**model, 'key': key, 'available': True})
             elif key == 'free':
                 available.append({**model, 'key': key, 'available': True})
@@ -402,13 +572,14 @@ class AIModelManager:
                 available.append({**model, 'key': key, 'available': False})
         return available
     
-    async def generate_response(self, prompt: str, model_key: str = 'free', user=None):
-        """Generate AI response using specified model"""
+    async def generate_response(self, prompt: str, model_key: str = 'free', user=None, prepaid: bool = False):
+        """Generate AI response using specified model (prepaid: the caller checks and charges the balance)"""
         try:
             model = self.models.get(model_key, self.models['free'])
+            premium = bool(user and user.is_premium())
             
             # Check if user can use this model
-            if model_key != 'free' and (not user or not user.is_premium()):
+            if model_key != 'free' and not premium and not prepaid:
                 if not user or user.wallet < model['cost']:
                     return {
                         'success': False,
@@ -416,21 +587,27 @@ class AIModelManager:
                         'upgrade_required': True
                     }
             
-            # Generate response based on provider
-            if model['provider'] == 'openai':
-                response = await self._openai_request(prompt, model['model_id'])
-            elif model['provider'] == 'anthropic':
-                response = await self._claude_request(prompt, model['model_id'])
-            elif model['provider'] == 'google':
-                response = await self._gemini_request(prompt, model['model_id'])
-            else:
-                response = await self._huggingface_request(prompt, model['model_id'])
+            # Serve repeated prompts from the response cache (admins always get a fresh answer)
+            use_cache = not (user and user.role == 'admin')
+            cache_key = self._cache_key(model['model_id'], prompt)
+            response = self._cache_get(cache_key) if use_cache else None
+            if response is None:
+                response = await self._provider_request(model, prompt)
+                # Canned fallbacks stand in for an outage - never cache them
+                if response['success'] and use_cache and not response.get('fallback'):
+                    self._cache_put(cache_key, response['content'])
             
             if response['success']:
                 # Deduct cost from user wallet (if not premium)
-                if user and model_key != 'free' and not user.is_premium():
-                    user.wallet -= model['cost']
-                    user.chats_count += 1
+                if user and model_key != 'free' and not premium:
+                    # Conditional UPDATE - fails instead of overdrawing if a
+                    # concurrent request spent the balance meanwhile
+                    if not debit_wallet(user.id, model['cost'], chats_count=User.chats_count + 1):
+                        return {
+                            'success': False,
+                            'error': f'Insufficient balance. Need ₹{model["cost"]} for {model["name"]}',
+                            'upgrade_required': True
+                        }
                     
                     # Add earnings to admin
                     admin_earnings = model['cost'] * ADMIN_SHARE
@@ -443,8 +620,9 @@ class AIModelManager:
                         model_name=model['name'],
                         cost=model['cost'],
                         earnings_generated=admin_earnings,
-                        request_data=prompt[:500],
-                        response_data=response['content'][:500]
+                        # Truncated by the database, no Python-side copies
+                        request_data=db.func.substr(prompt, 1, 500),
+                        response_data=db.func.substr(response['content'], 1, 500)
                     )
                     db.session.add(usage)
                     db.session.commit()
@@ -466,6 +644,17 @@ class AIModelManager:
                 'fallback': True
             }
     
+    async def _provider_request(self, model: Dict[str, Any], prompt: str):
+        """Generate response based on provider"""
+        if model['provider'] == 'openai':
+            return await self._openai_request(prompt, model['model_id'])
+        elif model['provider'] == 'anthropic':
+            return await self._claude_request(prompt, model['model_id'])
+        elif model['provider'] == 'google':
+            return await self._gemini_request(prompt, model['model_id'])
+        else:
+            return await self._huggingface_request(prompt, model['model_id'])
+    
     async def _openai_request(self, prompt: str, model: str):
         """Make request to OpenAI API"""
         try:
@@ -487,19 +676,18 @@ class AIModelManager:
                 'temperature': 0.7
             }
             
-            async with httpx.AsyncClient(timeout=OPENAI_TIMEOUT) as client:
-                response = await client.post(
-                    'https://api.openai.com/v1/chat/completions',
-                    headers=headers,
-                    json=data
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result['choices'][0]['message']['content']
-                    return {'success': True, 'content': content}
-                else:
-                    return {'success': False, 'error': f'OpenAI API error: {response.status_code}'}
+            response = await self._http_client().post(
+                'https://api.openai.com/v1/chat/completions',
+                headers=headers,
+                json=data
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                content = result['choices'][0]['message']['content']
+                return {'success': True, 'content': content}
+            else:
+                return {'success': False, 'error': f'OpenAI API error: {response.status_code}'}
                     
         except Exception as e:
             return {'success': False, 'error': f'OpenAI request failed: {str(e)}'}
@@ -519,34 +707,30 @@ class AIModelManager:
         try:
             if not HF_API_TOKEN or not HF_API_URL:
                 # Fallback response for free model
-                responses = [
-                    f"Hello! I'm Ganesh AI. You asked: '{prompt[:50]}...' - I'm here to help you with any questions!",
-                    f"Thanks for using Ganesh AI! Regarding '{prompt[:50]}...', I'd be happy to assist you further.",
-                    f"Great question about '{prompt[:50]}...'! As Ganesh AI, I'm designed to provide helpful responses.",
-                ]
-                return {'success': True, 'content': random.choice(responses)}
+                content = next(self._fallback_templates).format(prompt=prompt[:50])
+                return {'success': True, 'content': content, 'fallback': True}
             
             headers = {'Authorization': f'Bearer {HF_API_TOKEN}'}
             data = {'inputs': prompt}
             
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.post(HF_API_URL, headers=headers, json=data)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if isinstance(result, list) and len(result) > 0:
-                        content = result[0].get('generated_text', 'No response generated')
-                        return {'success': True, 'content': content}
-                    else:
-                        return {'success': False, 'error': 'Invalid response format'}
+            response = await self._http_client().post(HF_API_URL, headers=headers, json=data, timeout=30)
+            
+            if response.status_code == 200:
+                result = response.json()
+                if isinstance(result, list) and len(result) > 0:
+                    content = result[0].get('generated_text', 'No response generated')
+                    return {'success': True, 'content': content}
                 else:
-                    return {'success': False, 'error': f'HuggingFace API error: {response.status_code}'}
+                    return {'success': False, 'error': 'Invalid response format'}
+            else:
+                return {'success': False, 'error': f'HuggingFace API error: {response.status_code}'}
                     
         except Exception as e:
             # Fallback response
             return {
                 'success': True, 
-                'content': f"I'm Ganesh AI! You asked about '{prompt[:50]}...' - I'm here to help! For better responses, consider upgrading to premium models."
+                'content': f"I'm Ganesh AI! You asked about '{prompt[:50]}...' - I'm here to help! For better responses, consider upgrading to premium models.",
+                'fallback': True
             }
 
 # Initialize AI Manager
@@ -556,38 +740,172 @@ ai_manager = AIModelManager()
 # 💰 MONETIZATION SYSTEM 💰
 # =========================
 
+# Visit rows are append-only analytics, so they are written in batches by a
+# single background thread instead of one INSERT + commit per page view
+VISIT_BATCH_SIZE = int(os.getenv("VISIT_BATCH_SIZE", "200"))
+VISIT_FLUSH_INTERVAL = float(os.getenv("VISIT_FLUSH_INTERVAL", "0.05"))  # seconds
+
+_visit_queue = queue.SimpleQueue()
+_visit_writer_thread = None
+_visit_writer_lock = threading.Lock()
+
+def flush_visits(rows: List[Dict[str, Any]]):
+    """Insert a batch of visit rows and credit their earnings in a single transaction"""
+    if not rows:
+        return
+    try:
+        with app.app_context():
+            db.session.execute(db.insert(Visit), rows)
+            
+            # One credit per logged-in visitor, however many pages they hit in this batch
+            visitors: Dict[int, Dict[str, Any]] = {}
+            for row in rows:
+                if row['user_id']:
+                    visitor = visitors.setdefault(row['user_id'], {'visits': 0, 'earnings': 0.0})
+                    visitor['visits'] += 1
+                    visitor['earnings'] += row['earnings_generated']
+                    visitor['last_visit'] = row['created_at']
+            for user_id, visitor in visitors.items():
+                credit_earnings(
+                    user_id, visitor['earnings'], f"Visit earnings for {visitor['visits']} page(s)",
+                    visits_count=User.visits_count + visitor['visits'],
+                    last_visit=visitor['last_visit']
+                )
+            
+            # Admin share (70% of visit earnings) credited once per batch
+            admin_id = get_admin_user_id()
+            if admin_id:
+                admin_earnings = sum(row['earnings_generated'] for row in rows) * ADMIN_SHARE
+                credit_earnings(admin_id, admin_earnings, f"Admin share from {len(rows)} visits")
+            
+            db.session.commit()
+    except Exception as e:
+        log("monetization", "ERROR", f"Visit batch flush failed ({len(rows)} rows): {e}")
+
+def drain_visit_queue(block: bool = True) -> List[Dict[str, Any]]:
+    """Collect up to VISIT_BATCH_SIZE queued visits within one flush interval"""
+    rows = []
+    try:
+        if block:
+            rows.append(_visit_queue.get())
+        deadline = time.monotonic() + VISIT_FLUSH_INTERVAL
+        while len(rows) < VISIT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if not block:
+                rows.append(_visit_queue.get_nowait())
+            elif remaining > 0:
+                rows.append(_visit_queue.get(timeout=remaining))
+            else:
+                break
+    except queue.Empty:
+        pass
+    return rows
+
+def visit_writer():
+    """Background writer loop for queued visits"""
+    while True:
+        flush_visits(drain_visit_queue())
+
+def enqueue_visit(row: Dict[str, Any]):
+    """Queue a visit row and make sure the writer thread is running"""
+    global _visit_writer_thread
+    _visit_queue.put(row)
+    if _visit_writer_thread is None:
+        with _visit_writer_lock:
+            if _visit_writer_thread is None:
+                _visit_writer_thread = threading.Thread(target=visit_writer, name="visit-writer", daemon=True)
+                _visit_writer_thread.start()
+
+@atexit.register
+def flush_pending_visits():
+    """Write out visits still queued at shutdown"""
+    while True:
+        rows = drain_visit_queue(block=False)
+        if not rows:
+            break
+        flush_visits(rows)
+
+_admin_user_id = None
+
+def get_admin_user_id() -> Optional[int]:
+    """Id of the admin account that receives revenue shares (cached after first lookup)"""
+    global _admin_user_id
+    if _admin_user_id is None:
+        _admin_user_id = db.session.query(User.id).filter_by(role='admin').order_by(User.id).limit(1).scalar()
+    return _admin_user_id
+
+def credit_earnings(user_id: int, amount: float, description: str, **values) -> bool:
+    """Atomically credit a user's wallet in the current transaction without loading the row"""
+    result = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(wallet=User.wallet + amount, total_earned=User.total_earned + amount, **values),
+        execution_options={'synchronize_session': False}
+    )
+    if not result.rowcount:
+        return False
+    
+    db.session.add(Transaction(
+        user_id=user_id,
+        amount=amount,
+        transaction_type='credit',
+        status='completed',
+        description=description
+    ))
+    return True
+
+def debit_wallet(user_id: int, amount: float, **values) -> bool:
+    """Atomically deduct from a user's wallet only if the balance covers it"""
+    result = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.wallet >= amount)
+        .values(wallet=User.wallet - amount, **values),
+        execution_options={'synchronize_session': False}
+    )
+    return result.rowcount == 1
+
+def bulk_credit(credits: List[tuple], description: str) -> int:
+    """Credit (user_id, amount) pairs in the current transaction with one executemany per statement"""
+    if not credits:
+        return 0
+    users = User.__table__
+    db.session.execute(
+        users.update()
+        .where(users.c.id == bindparam('uid'))
+        .values(
+            wallet=users.c.wallet + bindparam('amount'),
+            total_earned=users.c.total_earned + bindparam('amount')
+        ),
+        [{'uid': user_id, 'amount': amount} for user_id, amount in credits]
+    )
+    db.session.execute(db.insert(Transaction), [
+        {
+            'user_id': user_id,
+            'amount': amount,
+            'transaction_type': 'credit',
+            'status': 'completed',
+            'description': description
+        }
+        for user_id, amount in credits
+    ])
+    return len(credits)
+
 def track_visit(user_id=None, page='/', referrer=None):
     """Track user visit and generate earnings"""
     try:
         ip_address = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
         user_agent = request.headers.get('User-Agent', '')
         
-        # Create visit record
-        visit = Visit(
-            user_id=user_id,
-            ip_address=ip_address,
-            user_agent=user_agent,
-            page=page,
-            referrer=referrer,
-            earnings_generated=VISIT_PAY_RATE
-        )
-        db.session.add(visit)
-        
-        # Add earnings to user if logged in
-        if user_id:
-            user = User.query.get(user_id)
-            if user:
-                user.visits_count += 1
-                user.last_visit = datetime.utcnow()
-                user.add_earnings(VISIT_PAY_RATE, f"Visit earnings for {page}")
-        
-        # Add earnings to admin (70% of visit earnings)
-        admin_user = User.query.filter_by(role='admin').first()
-        if admin_user:
-            admin_earnings = VISIT_PAY_RATE * ADMIN_SHARE
-            admin_user.add_earnings(admin_earnings, f"Admin share from visit to {page}")
-        
-        db.session.commit()
+        # Queue visit record for the background writer, which also credits its earnings
+        enqueue_visit({
+            'user_id': user_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'page': page,
+            'referrer': referrer,
+            'earnings_generated': VISIT_PAY_RATE,
+            'created_at': datetime.utcnow()
+        })
         log("monetization", "INFO", f"Visit tracked: {page} - Earnings: ₹{VISIT_PAY_RATE}")
         
     except Exception as e:
@@ -596,32 +914,35 @@ def track_visit(user_id=None, page='/', referrer=None):
 def process_referral(referral_code, new_user_id):
     """Process referral bonus"""
     try:
-        referrer = User.query.filter_by(referral_code=referral_code).first()
-        if referrer and referrer.id != new_user_id:
+        referrer_id = db.session.query(User.id).filter_by(referral_code=referral_code).scalar()
+        if referrer_id and referrer_id != new_user_id:
             # Add referral bonus to referrer
-            referrer.add_earnings(REFERRAL_BONUS, f"Referral bonus for user {new_user_id}")
-            referrer.referrals_count += 1
+            credit_earnings(
+                referrer_id, REFERRAL_BONUS, f"Referral bonus for user {new_user_id}",
+                referrals_count=User.referrals_count + 1
+            )
             
             # Create referral record
             referral = Referral(
-                referrer_id=referrer.id,
+                referrer_id=referrer_id,
                 referred_id=new_user_id,
                 referral_code=referral_code,
                 bonus_amount=REFERRAL_BONUS
             )
             db.session.add(referral)
             
-            # Update referred user
-            new_user = User.query.get(new_user_id)
-            if new_user:
-                new_user.referred_by = referral_code
-                # Give welcome bonus to new user
-                new_user.add_earnings(REFERRAL_BONUS * 0.1, "Welcome bonus from referral")
+            # Update referred user and give welcome bonus
+            credit_earnings(
+                new_user_id, REFERRAL_BONUS * 0.1, "Welcome bonus from referral",
+                referred_by=referral_code
+            )
             
+            # One commit for both credits and the referral record
             db.session.commit()
             log("monetization", "INFO", f"Referral processed: {referral_code} -> User {new_user_id}")
             return True
     except Exception as e:
+        db.session.rollback()
         log("monetization", "ERROR", f"Referral processing failed: {e}")
     return False
 
@@ -631,15 +952,39 @@ def generate_ad_revenue():
         # Simulate ad clicks and impressions
         daily_ad_revenue = random.uniform(50, 200)  # ₹50-200 per day
         
-        admin_user = User.query.filter_by(role='admin').first()
-        if admin_user:
-            admin_user.add_earnings(daily_ad_revenue, "Daily ad revenue")
+        admin_id = get_admin_user_id()
+        if admin_id and credit_earnings(admin_id, daily_ad_revenue, "Daily ad revenue"):
             db.session.commit()
             log("monetization", "INFO", f"Ad revenue generated: ₹{daily_ad_revenue}")
             
     except Exception as e:
+        db.session.rollback()
         log("monetization", "ERROR", f"Ad revenue generation failed: {e}")
 
+SITE_STATS_TTL = int(os.getenv("SITE_STATS_TTL", "60"))  # seconds
+_site_stats = {'expires': 0.0, 'values': None}
+_site_stats_lock = threading.Lock()
+
+def get_site_stats() -> Dict[str, Any]:
+    """Home page totals, aggregated in SQL and cached for SITE_STATS_TTL seconds"""
+    with _site_stats_lock:
+        if _site_stats['values'] is not None and time.monotonic() < _site_stats['expires']:
+            return _site_stats['values']
+    
+    total_users, total_earnings = db.session.query(
+        db.func.count(User.id), db.func.coalesce(db.func.sum(User.total_earned), 0.0)
+    ).one()
+    values = {
+        'total_users': total_users,
+        'total_chats': db.session.query(db.func.count(APIUsage.id)).scalar(),
+        'total_earnings': round(total_earnings, 2)
+    }
+    
+    with _site_stats_lock:
+        _site_stats['values'] = values
+        _site_stats['expires'] = time.monotonic() + SITE_STATS_TTL
+    return values
+
 def query_openai(prompt: str, user_id: Optional[int] = None) -> str:
     """Legacy OpenAI function - now uses AI Manager"""
     try:
@@ -681,7 +1026,7 @@ def index():
     user_id = session.get('user_id')
     track_visit(user_id, '/', request.referrer)
     
-    return render_template_string("""
+    return render_page("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -1077,12 +1422,10 @@ def index():
     </html>
     """, 
     app_name=APP_NAME,
-    telegram_username=TELEGRAM_TOKEN.split(':')[0] if TELEGRAM_TOKEN else 'ganeshaibot',
+    telegram_username=TELEGRAM_USERNAME,
     support_username=SUPPORT_USERNAME,
     business_email=BUSINESS_EMAIL,
-    total_users=User.query.count(),
-    total_chats=APIUsage.query.count(),
-    total_earnings=round(sum([u.total_earned for u in User.query.all()]), 2)
+    **get_site_stats()
     )
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -1097,12 +1440,15 @@ def register():
             flash('All fields are required.', 'error')
             return redirect(url_for('register'))
         
-        # Check if user exists
-        if User.query.filter_by(username=username).first():
+        # Check if user exists (one query for both unique columns)
+        existing = db.session.query(User.username, User.email).filter(
+            db.or_(User.username == username, User.email == email)
+        ).order_by(db.case((User.username == username, 0), else_=1)).first()
+        if existing and existing.username == username:
             flash('Username already exists.', 'error')
             return redirect(url_for('register'))
         
-        if User.query.filter_by(email=email).first():
+        if existing:
             flash('Email already registered.', 'error')
             return redirect(url_for('register'))
         
@@ -1115,7 +1461,7 @@ def register():
         flash('Registration successful! Please log in.', 'success')
         return redirect(url_for('login'))
     
-    return render_template_string("""
+    return render_page("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -1207,7 +1553,7 @@ def login():
         else:
             flash('Invalid username or password.', 'error')
     
-    return render_template_string("""
+    return render_page("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -1280,20 +1626,20 @@ def dashboard():
     """Modern ChatGPT-style Dashboard with Visit Tracking"""
     user = User.query.get(session['user_id'])
     
-    # Track visit for monetization
-    track_visit(user.id, '/dashboard', request.referrer)
-    
     # Generate referral code if not exists
     if not user.referral_code:
         user.generate_referral_code()
         db.session.commit()
     
+    # Track visit for monetization
+    track_visit(user.id, '/dashboard', request.referrer)
+    
     # Get user's recent data
     transactions = Transaction.query.filter_by(user_id=user.id).order_by(Transaction.created_at.desc()).limit(5).all()
     api_usage = APIUsage.query.filter_by(user_id=user.id).order_by(APIUsage.created_at.desc()).limit(5).all()
     available_models = ai_manager.get_available_models(user)
     
-    return render_template_string("""
+    return render_page("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -1866,20 +2212,49 @@ def dashboard():
 # TELEGRAM BOT SETUP
 # =========================
 
+def is_valid_telegram_token(token: str) -> bool:
+    """Check the "<bot id>:<secret>" token shape without the regex engine"""
+    bot_id, sep, secret = token.partition(':')
+    return bool(
+        sep and bot_id.isascii() and bot_id.isdigit()
+        and len(secret) >= 20 and TELEGRAM_TOKEN_CHARS.issuperset(secret)
+    )
+
+def validate_telegram_config() -> Optional[str]:
+    """Return why the bot cannot start with the current settings, or None if it can"""
+    if not is_valid_telegram_token(TELEGRAM_TOKEN):
+        return "Telegram token is malformed"
+    if not 1 <= TELEGRAM_PORT <= 65535:
+        return f"TELEGRAM_PORT {TELEGRAM_PORT} is out of range"
+    if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100:
+        return f"WEBHOOK_MAX_CONNECTIONS {WEBHOOK_MAX_CONNECTIONS} must be between 1 and 100"
+    if not DEBUG and not TELEGRAM_WEBHOOK_URL.startswith("https://"):
+        return f"Webhook URL {TELEGRAM_WEBHOOK_URL} must use https"
+    return None
+
+# Checked once at import so setup_telegram() fails fast without building the Application
+TELEGRAM_CONFIG_ERROR = validate_telegram_config() if TELEGRAM_TOKEN else None
+
 def setup_telegram():
     """Setup Telegram bot with handlers"""
     if not TELEGRAM_TOKEN:
         log("telegram", "WARNING", "Telegram token not configured. Skipping bot setup.")
         return
+    if TELEGRAM_CONFIG_ERROR:
+        log("telegram", "ERROR", f"{TELEGRAM_CONFIG_ERROR}. Skipping bot setup.")
+        return
     
     try:
-        from telegram import Update
-        from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-        import threading
-        
         # Create application
         global telegram_app
-        telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
+        telegram_app = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(True)  # don't serialize slow AI replies across users
+            .connection_pool_size(TELEGRAM_POOL_SIZE)
+            .pool_timeout(5.0)  # wait for a pooled connection under bursts instead of failing
+            .build()
+        )
         
         # Add handlers
         telegram_app.add_handler(CommandHandler("start", tg_start))
@@ -1889,24 +2264,39 @@ def setup_telegram():
         telegram_app.add_handler(CommandHandler("gpt3", lambda update, context: tg_model_select(update, context, "gpt-3.5-turbo")))
         telegram_app.add_handler(CommandHandler("balance", tg_balance))
         telegram_app.add_handler(CommandHandler("help", tg_help))
+        telegram_app.add_handler(CommandHandler("bulkcredit", tg_bulk_credit))
         telegram_app.add_handler(CallbackQueryHandler(tg_callback_query))
         telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, tg_message))
         
         # Start bot in a separate thread for production
         def start_bot():
             try:
+                # PTB needs its own event loop in this thread, and signal
+                # handlers can only be installed from the main thread
+                asyncio.set_event_loop(uvloop.new_event_loop() if uvloop else asyncio.new_event_loop())
+                
                 if not DEBUG:
                     # Use webhook mode for production
-                    webhook_url = f"{DOMAIN}/telegram_webhook"
                     telegram_app.run_webhook(
                         listen="0.0.0.0",
-                        port=int(os.getenv('TELEGRAM_PORT', 8443)),
-                        webhook_url=webhook_url,
-                        url_path="telegram_webhook"
+                        port=TELEGRAM_PORT,
+                        webhook_url=TELEGRAM_WEBHOOK_URL,
+                        url_path=TELEGRAM_WEBHOOK_PATH,
+                        allowed_updates=TELEGRAM_ALLOWED_UPDATES,
+                        max_connections=WEBHOOK_MAX_CONNECTIONS,
+                        secret_token=TELEGRAM_WEBHOOK_SECRET,
+                        drop_pending_updates=TELEGRAM_DROP_PENDING_UPDATES,
+                        stop_signals=None
                     )
                 else:
                     # For development, use polling
-                    telegram_app.run_polling()
+                    telegram_app.run_polling(
+                        poll_interval=0.0,
+                        timeout=TELEGRAM_POLL_TIMEOUT,
+                        allowed_updates=TELEGRAM_ALLOWED_UPDATES,
+                        drop_pending_updates=TELEGRAM_DROP_PENDING_UPDATES,
+                        stop_signals=None
+                    )
             except Exception as e:
                 log("telegram", "ERROR", f"Bot thread error: {e}")
         
@@ -1916,8 +2306,6 @@ def setup_telegram():
         
         log("telegram", "INFO", "Telegram bot setup completed successfully")
         
-    except ImportError:
-        log("telegram", "ERROR", "python-telegram-bot not installed. Skipping bot setup.")
     except Exception as e:
         log("telegram", "ERROR", f"Failed to setup Telegram bot: {e}")
 
@@ -1928,6 +2316,123 @@ telegram_app = None
 # TELEGRAM BOT HANDLERS
 # =========================
 
+# Only the update types the handlers below consume; Telegram skips sending the rest
+TELEGRAM_ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Per-message model pricing and the AIModelManager key serving each, built once at import
+TELEGRAM_MODELS = {
+    "gpt-4": {"name": "GPT-4 Turbo", "cost": 2.00, "key": "gpt4"},
+    "claude-3-sonnet": {"name": "Claude 3 Sonnet", "cost": 1.50, "key": "claude"},
+    "gemini-pro": {"name": "Gemini Pro", "cost": 1.00, "key": "gemini"},
+    "gpt-3.5-turbo": {"name": "GPT-3.5 Turbo", "cost": 1.50, "key": "gpt3.5"}
+}
+TELEGRAM_DEFAULT_MODEL = {"name": "Unknown", "cost": 0.10, "key": "free"}
+
+# Callback data of the form "model_<name>" (compiled once, anchored so a
+# name that itself contains "model_" is not mangled)
+MODEL_CALLBACK_RE = re.compile(r"^model_([\w.-]+)$")
+
+def run_in_app_context(func, *args, **kwargs):
+    """Run a database helper inside a fresh app context"""
+    with app.app_context():
+        return func(*args, **kwargs)
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper in a worker thread so the bot loop keeps serving updates"""
+    return await asyncio.to_thread(run_in_app_context, func, *args, **kwargs)
+
+# The only user columns the bot replies with
+TELEGRAM_USER_COLUMNS = (
+    User.id, User.wallet, User.total_earned, User.chats_count,
+    User.referrals_count, User.referral_code
+)
+
+def telegram_user_fields(user) -> Dict[str, Any]:
+    """Copy the fields the bot replies with, so they outlive the worker's session"""
+    return {column.key: getattr(user, column.key) for column in TELEGRAM_USER_COLUMNS}
+
+TELEGRAM_USER_CACHE_TTL = int(os.getenv("TELEGRAM_USER_CACHE_TTL", "30"))  # seconds
+TELEGRAM_USER_CACHE_SIZE = int(os.getenv("TELEGRAM_USER_CACHE_SIZE", "10000"))  # max cached users
+_telegram_user_cache: Dict[str, tuple] = {}
+_telegram_user_cache_lock = threading.Lock()
+
+def cache_telegram_user(telegram_id: str, fields: Optional[Dict[str, Any]]):
+    """Remember (or with None, forget) a user snapshot for TELEGRAM_USER_CACHE_TTL seconds"""
+    now = time.monotonic()
+    with _telegram_user_cache_lock:
+        # Re-insert so dict order stays oldest-first
+        _telegram_user_cache.pop(telegram_id, None)
+        if fields is None:
+            return
+        # One shared TTL makes insertion order expiry order, so only the head needs checking
+        while _telegram_user_cache:
+            oldest = next(iter(_telegram_user_cache))
+            if _telegram_user_cache[oldest][0] > now and len(_telegram_user_cache) < TELEGRAM_USER_CACHE_SIZE:
+                break
+            del _telegram_user_cache[oldest]
+        _telegram_user_cache[telegram_id] = (now + TELEGRAM_USER_CACHE_TTL, fields)
+
+def cached_telegram_user(telegram_id: str) -> Optional[Dict[str, Any]]:
+    """Recent user snapshot without a database round trip, or None"""
+    with _telegram_user_cache_lock:
+        entry = _telegram_user_cache.get(telegram_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def get_telegram_user(telegram_id: str) -> Optional[Dict[str, Any]]:
+    """Look up a Telegram user by chat id, selecting only the columns the bot uses"""
+    row = db.session.query(*TELEGRAM_USER_COLUMNS).filter_by(telegram_id=telegram_id).first()
+    fields = row._asdict() if row else None
+    cache_telegram_user(telegram_id, fields)
+    return fields
+
+def get_telegram_wallet(telegram_id: str) -> Optional[float]:
+    """Wallet balance of a Telegram user (None if unregistered), without loading the row"""
+    return db.session.query(db.func.coalesce(User.wallet, 0.0)).filter(User.telegram_id == telegram_id).scalar()
+
+def get_or_create_telegram_user(telegram_id: str, username: str):
+    """Look up a Telegram user, registering them with the welcome bonus on first contact"""
+    fields = get_telegram_user(telegram_id)
+    if fields:
+        return fields, False
+    
+    user = User(
+        username=username,
+        email=f"{username}@telegram.user",
+        telegram_id=telegram_id
+    )
+    user.set_password("telegram_user")
+    user.generate_referral_code()
+    user.wallet = 25.0  # Welcome bonus
+    db.session.add(user)
+    db.session.commit()
+    return telegram_user_fields(user), True
+
+def bulk_credit_usernames(admin_telegram_id: str, credits: Dict[str, float]):
+    """Credit wallets by username for a Telegram admin; returns (credited, unknown) or None if not an admin"""
+    if not db.session.query(User.id).filter_by(telegram_id=admin_telegram_id, role='admin').limit(1).scalar():
+        return None
+    ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(list(credits))).all())
+    credited = bulk_credit([(ids[name], amount) for name, amount in credits.items() if name in ids], "Admin bulk credit")
+    db.session.commit()
+    return credited, [name for name in credits if name not in ids]
+
+def charge_telegram_chat(user_id: int, cost: float, model_name: str) -> Optional[float]:
+    """Charge a bot chat and record it; returns the new balance, or None if funds ran out"""
+    if not debit_wallet(user_id, cost, chats_count=User.chats_count + 1):
+        db.session.rollback()
+        return None
+    db.session.add(Transaction(
+        user_id=user_id,
+        amount=-cost,
+        transaction_type='chat',
+        status='completed',
+        description=f"AI Chat - {model_name}"
+    ))
+    db.session.commit()
+    return db.session.query(User.wallet).filter_by(id=user_id).scalar()
+
 async def tg_start(update: Update, context):
     """Handle /start command"""
     try:
@@ -1935,24 +2440,13 @@ async def tg_start(update: Update, context):
         username = update.effective_user.username or f"user_{user_id}"
         
         # Get or create user
-        user = User.query.filter_by(telegram_id=user_id).first()
-        if not user:
-            user = User(
-                username=username,
-                email=f"{username}@telegram.user",
-                telegram_id=user_id
-            )
-            user.set_password("telegram_user")
-            user.generate_referral_code()
-            user.wallet = 25.0  # Welcome bonus
-            db.session.add(user)
-            db.session.commit()
-            
+        user, created = await run_db(get_or_create_telegram_user, user_id, username)
+        if created:
             welcome_text = f"""
 🎉 **Welcome to {APP_NAME}!**
 
 🎁 **Welcome Bonus**: ₹25 credited to your account!
-💰 **Your Balance**: ₹{user.wallet:.2f}
+💰 **Your Balance**: ₹{user['wallet']:.2f}
 
 🤖 **Available AI Models**:
 /gpt4 - GPT-4 Turbo (₹2.00/chat)
@@ -1973,9 +2467,9 @@ Start chatting with any AI model! 🚀
             welcome_text = f"""
 👋 **Welcome back to {APP_NAME}!**
 
-💰 **Your Balance**: ₹{user.wallet:.2f}
-📊 **Total Chats**: {user.chats_count}
-🎯 **Referrals**: {user.referrals_count}
+💰 **Your Balance**: ₹{user['wallet']:.2f}
+📊 **Total Chats**: {user['chats_count']}
+🎯 **Referrals**: {user['referrals_count']}
 
 🤖 **Select AI Model**:
 /gpt4 - GPT-4 Turbo (₹2.00/chat)
@@ -1996,28 +2490,21 @@ async def tg_model_select(update: Update, context, model_name: str):
     """Handle model selection commands"""
     try:
         user_id = str(update.effective_user.id)
-        user = User.query.filter_by(telegram_id=user_id).first()
+        wallet = await run_db(get_telegram_wallet, user_id)
         
-        if not user:
+        if wallet is None:
             await update.message.reply_text("❌ Please start with /start first.")
             return
             
         # Store selected model in context
         context.user_data['selected_model'] = model_name
         
-        model_info = {
-            "gpt-4": {"name": "GPT-4 Turbo", "cost": 2.00},
-            "claude-3-sonnet": {"name": "Claude 3 Sonnet", "cost": 1.50},
-            "gemini-pro": {"name": "Gemini Pro", "cost": 1.00},
-            "gpt-3.5-turbo": {"name": "GPT-3.5 Turbo", "cost": 1.50}
-        }
-        
-        info = model_info.get(model_name, {"name": "Unknown", "cost": 0.10})
+        info = TELEGRAM_MODELS.get(model_name, TELEGRAM_DEFAULT_MODEL)
         
         await update.message.reply_text(
             f"🤖 **{info['name']} Selected**\n\n"
             f"💰 **Cost**: ₹{info['cost']:.2f} per message\n"
-            f"💳 **Your Balance**: ₹{user.wallet:.2f}\n\n"
+            f"💳 **Your Balance**: ₹{wallet:.2f}\n\n"
             f"💬 Send me your message to start chatting!",
             parse_mode='Markdown'
         )
@@ -2030,7 +2517,7 @@ async def tg_balance(update: Update, context):
     """Handle /balance command"""
     try:
         user_id = str(update.effective_user.id)
-        user = User.query.filter_by(telegram_id=user_id).first()
+        user = await run_db(get_telegram_user, user_id)
         
         if not user:
             await update.message.reply_text("❌ Please start with /start first.")
@@ -2039,12 +2526,12 @@ async def tg_balance(update: Update, context):
         balance_text = f"""
 💰 **Account Balance**
 
-💳 **Current Balance**: ₹{user.wallet:.2f}
-📊 **Total Earned**: ₹{user.total_earned:.2f}
-💬 **Total Chats**: {user.chats_count}
-🎯 **Referrals**: {user.referrals_count}
+💳 **Current Balance**: ₹{user['wallet']:.2f}
+📊 **Total Earned**: ₹{user['total_earned']:.2f}
+💬 **Total Chats**: {user['chats_count']}
+🎯 **Referrals**: {user['referrals_count']}
 
-🔗 **Referral Code**: `{user.referral_code}`
+🔗 **Referral Code**: `{user['referral_code']}`
 💡 **Earn ₹10 for each referral!**
 
 🌐 **Web Dashboard**: {DOMAIN}
@@ -2056,9 +2543,8 @@ async def tg_balance(update: Update, context):
         log("telegram", "ERROR", f"Error in /balance command: {e}")
         await update.message.reply_text("❌ Error fetching balance. Please try again.")
 
-async def tg_help(update: Update, context):
-    """Handle /help command"""
-    help_text = f"""
+# Help text only depends on configuration, so it is formatted once
+TELEGRAM_HELP_TEXT = f"""
 🤖 **{APP_NAME} - Help**
 
 **🎯 Available Commands:**
@@ -2069,6 +2555,7 @@ async def tg_help(update: Update, context):
 /gpt3 - Use GPT-3.5 Turbo (₹1.50/chat)
 /balance - Check your balance and stats
 /help - Show this help message
+/bulkcredit username:amount ... - Credit several wallets (bot admins with a linked admin account only)
 
 **💰 How to Earn:**
 • Get ₹25 welcome bonus on signup
@@ -2087,38 +2574,81 @@ async def tg_help(update: Update, context):
 
 Need more help? Contact {SUPPORT_USERNAME}
 """
+
+async def tg_help(update: Update, context):
+    """Handle /help command"""
+    await update.message.reply_text(TELEGRAM_HELP_TEXT, parse_mode='Markdown')
+
+async def tg_bulk_credit(update: Update, context):
+    """Handle /bulkcredit username:amount ... (admins only)"""
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        await update.message.reply_text("❌ This command is for admins only.")
+        return
     
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    try:
+        credits = {}
+        for arg in context.args or []:
+            name, _, amount = arg.partition(':')
+            amount = float(amount)
+            # float() accepts nan/inf and negatives - none of them are valid credits
+            if not (math.isfinite(amount) and amount > 0):
+                raise ValueError(f"invalid amount for {name}")
+            # A repeated name is most likely a typo - refuse rather than guess
+            if not name or name in credits:
+                raise ValueError(f"missing or repeated username {name!r}")
+            credits[name] = amount
+        if not credits:
+            raise ValueError("no credits given")
+    except ValueError:
+        await update.message.reply_text("Usage: /bulkcredit username:amount [username:amount ...] (each username once)")
+        return
+    
+    try:
+        result = await run_db(bulk_credit_usernames, str(update.effective_user.id), credits)
+        if result is None:
+            await update.message.reply_text("❌ This command is for admins only.")
+            return
+        
+        credited, unknown = result
+        reply = f"✅ Credited {credited} user(s)."
+        if unknown:
+            reply += f"\n⚠️ Unknown users: {', '.join(unknown)}"
+        await update.message.reply_text(reply)
+        log("telegram", "INFO", f"Bulk credit by {update.effective_user.id}: {credited} users")
+        
+    except Exception as e:
+        log("telegram", "ERROR", f"Error in /bulkcredit command: {e}")
+        await update.message.reply_text("❌ Bulk credit failed. No wallets were changed.")
+
+TELEGRAM_SUPERSEDED_TEXT = "⏭️ Skipped — answering your newer message"
 
 async def tg_message(update: Update, context):
     """Handle regular text messages"""
     try:
         user_id = str(update.effective_user.id)
-        user = User.query.filter_by(telegram_id=user_id).first()
         
-        if not user:
-            await update.message.reply_text("❌ Please start with /start first.")
-            return
-            
         # Get selected model or use default
         selected_model = context.user_data.get('selected_model', 'gpt-3.5-turbo')
         message_text = update.message.text
+        model_info = TELEGRAM_MODELS.get(selected_model, TELEGRAM_DEFAULT_MODEL)
+        cost = model_info["cost"]
         
-        # Check if user has sufficient balance
-        model_costs = {
-            "gpt-4": 2.00,
-            "claude-3-sonnet": 1.50,
-            "gemini-pro": 1.00,
-            "gpt-3.5-turbo": 1.50
-        }
+        # A cached snapshot is enough to go ahead (the conditional debit enforces the
+        # balance), but only refuse on a fresh read
+        user = cached_telegram_user(user_id)
+        if user is None or user['wallet'] < cost:
+            user = await run_db(get_telegram_user, user_id)
         
-        cost = model_costs.get(selected_model, 0.10)
-        
-        if user.wallet < cost:
+        if not user:
+            await update.message.reply_text("❌ Please start with /start first.")
+            return
+            
+        # Check if user has sufficient balance
+        if user['wallet'] < cost:
             await update.message.reply_text(
                 f"❌ **Insufficient Balance**\n\n"
                 f"💰 **Required**: ₹{cost:.2f}\n"
-                f"💳 **Your Balance**: ₹{user.wallet:.2f}\n\n"
+                f"💳 **Your Balance**: ₹{user['wallet']:.2f}\n\n"
                 f"🔗 **Add funds**: {DOMAIN}\n"
                 f"🎯 **Refer friends**: Earn ₹10 per referral!",
                 parse_mode='Markdown'
@@ -2128,30 +2658,49 @@ async def tg_message(update: Update, context):
         # Send typing indicator
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
         
-        # Get AI response
-        ai_manager = AIModelManager()
-        response = await ai_manager.get_response(message_text, selected_model)
+        # Get AI response (shared manager keeps its pooled client and cache). A newer
+        # message from the same user cancels this request before it is charged.
+        # Handlers run concurrently, so "newer" is decided by update_id rather than
+        # by which handler gets here first
+        update_id = update.update_id
+        if update_id < context.user_data.get('latest_update_id', 0):
+            log("telegram", "INFO", f"Superseded message from user {user_id} skipped")
+            await update.message.reply_text(TELEGRAM_SUPERSEDED_TEXT)
+            return
+        context.user_data['latest_update_id'] = update_id
         
-        if response:
-            # Deduct cost and update stats
-            user.wallet -= cost
-            user.chats_count += 1
-            
-            # Add transaction record
-            transaction = Transaction(
-                user_id=user.id,
-                amount=-cost,
-                transaction_type='chat',
-                status='completed',
-                description=f"AI Chat - {selected_model}"
-            )
-            db.session.add(transaction)
-            db.session.commit()
+        previous = context.user_data.get('inflight')  # (update_id, task)
+        if previous and previous[0] < update_id and not previous[1].done():
+            previous[1].cancel()
+        ai_task = asyncio.ensure_future(ai_manager.generate_response(message_text, model_info["key"], prepaid=True))
+        context.user_data['inflight'] = (update_id, ai_task)
+        try:
+            response = await ai_task
+        except asyncio.CancelledError:
+            inflight = context.user_data.get('inflight')
+            if inflight is None or inflight[1] is ai_task:
+                raise  # the handler itself is being cancelled, not superseded
+            log("telegram", "INFO", f"Superseded message from user {user_id} cancelled")
+            await update.message.reply_text(TELEGRAM_SUPERSEDED_TEXT)
+            return
+        finally:
+            inflight = context.user_data.get('inflight')
+            if inflight and inflight[1] is ai_task:
+                context.user_data.pop('inflight')
+        
+        if response['success']:
+            # Deduct cost, update stats and record the transaction off the loop
+            balance = await run_db(charge_telegram_chat, user['id'], cost, selected_model)
+            if balance is None:
+                cache_telegram_user(user_id, None)
+                await update.message.reply_text("❌ Insufficient balance. Please add funds and try again.")
+                return
+            cache_telegram_user(user_id, {**user, 'wallet': balance, 'chats_count': user['chats_count'] + 1})
             
             # Send response
             await update.message.reply_text(
-                f"🤖 **{selected_model.upper()}**: {response}\n\n"
-                f"💰 **Balance**: ₹{user.wallet:.2f} (-₹{cost:.2f})",
+                f"🤖 **{selected_model.upper()}**: {response['content']}\n\n"
+                f"💰 **Balance**: ₹{balance:.2f} (-₹{cost:.2f})",
                 parse_mode='Markdown'
             )
             
@@ -2171,8 +2720,9 @@ async def tg_callback_query(update: Update, context):
         await query.answer()
         
         # Handle different callback data
-        if query.data.startswith('model_'):
-            model_name = query.data.replace('model_', '')
+        match = MODEL_CALLBACK_RE.match(query.data or '')
+        if match:
+            model_name = match.group(1)
             context.user_data['selected_model'] = model_name
             await query.edit_message_text(f"✅ Model {model_name} selected! Send your message.")
             
@@ -2183,11 +2733,32 @@ async def tg_callback_query(update: Update, context):
 # MAIN APPLICATION STARTUP
 # =========================
 
+def ensure_indexes() -> bool:
+    """Create model indexes that are missing on tables created before they were added; returns False if any failed"""
+    ok = True
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                ok = False
+                log("database", "WARNING", f"Could not create index {index.name}: {e}")
+    return ok
+
+# Bump whenever migrate_database() gains a new column or index
+SCHEMA_VERSION = 2
+
 def migrate_database():
     """Migrate database schema to add missing columns"""
     try:
         from sqlalchemy import inspect, text
         
+        # SQLite databases stamped with the current schema need no inspection
+        is_sqlite = db.engine.dialect.name == 'sqlite'
+        if is_sqlite and db.session.execute(text("PRAGMA user_version")).scalar() >= SCHEMA_VERSION:
+            log("database", "INFO", "Database schema is up to date")
+            return
+        
         # Check if we need to add new columns
         inspector = inspect(db.engine)
         
@@ -2199,6 +2770,7 @@ def migrate_database():
         columns = [col['name'] for col in inspector.get_columns('users')]
         
         missing_columns = []
+        failed_columns = []
         required_columns = [
             'total_earned', 'visits_count', 'chats_count', 'referrals_count',
             'referral_code', 'referred_by', 'premium_until', 'last_visit'
@@ -2225,6 +2797,7 @@ def migrate_database():
                     
                     log("database", "INFO", f"Added column: {col}")
                 except Exception as e:
+                    failed_columns.append(col)
                     log("database", "WARNING", f"Could not add column {col}: {e}")
             
             # Commit changes
@@ -2232,6 +2805,15 @@ def migrate_database():
             log("database", "INFO", "Database migration completed")
         else:
             log("database", "INFO", "Database schema is up to date")
+        
+        indexes_ok = ensure_indexes()
+        
+        # Only stamp a fully applied schema so failed steps are retried on next start
+        if failed_columns or not indexes_ok:
+            log("database", "WARNING", "Schema migration incomplete, will retry on next start")
+        elif is_sqlite:
+            db.session.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+            db.session.commit()
             
     except Exception as e:
         log("database", "ERROR", f"Database migration failed: {e}")
@@ -2285,7 +2867,7 @@ if __name__ == '__main__':
     log("system", "INFO", f"🌐 {APP_NAME} starting on {host}:{port}")
     log("system", "INFO", f"🔗 Web App: {DOMAIN}")
     log("system", "INFO", f"👨‍💼 Admin Panel: {DOMAIN}/admin")
-    log("system", "INFO", f"📱 Telegram Bot: https://t.me/{TELEGRAM_TOKEN.split(':')[0] if TELEGRAM_TOKEN else 'Not configured'}")
+    log("system", "INFO", f"📱 Telegram Bot: https://t.me/{TELEGRAM_USERNAME if TELEGRAM_TOKEN else 'Not configured'}")
     
     app.run(
         host=host,
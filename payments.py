@@ -1,4 +1,6 @@
 import os
+import asyncio
+import weakref
 import httpx
 import stripe
 import razorpay
@@ -50,15 +52,28 @@ def create_paypal_order(amount, currency="USD"):
 CASHFREE_CLIENT_ID = os.getenv("CASHFREE_CLIENT_ID")
 CASHFREE_CLIENT_SECRET = os.getenv("CASHFREE_CLIENT_SECRET")
 CASHFREE_BASE_URL = "https://sandbox.cashfree.com/pg"  # change to prod later
+CASHFREE_HEADERS = {
+    "x-client-id": CASHFREE_CLIENT_ID,
+    "x-client-secret": CASHFREE_CLIENT_SECRET,
+    "x-api-version": "2022-09-01"
+}
+
+# One pooled client per event loop so calls reuse the TCP/TLS connection
+_cashfree_clients = weakref.WeakKeyDictionary()
+
+def cashfree_client():
+    """Shared keep-alive Cashfree client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _cashfree_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _cashfree_clients[loop] = httpx.AsyncClient(
+            base_url=CASHFREE_BASE_URL,
+            headers=CASHFREE_HEADERS,
+            timeout=30.0
+        )
+    return client
 
 async def create_cashfree_order(order_id: str, amount: float, email: str, phone: str):
-    url = f"{CASHFREE_BASE_URL}/orders"
-    headers = {
-        "Content-Type": "application/json",
-        "x-client-id": CASHFREE_CLIENT_ID,
-        "x-client-secret": CASHFREE_CLIENT_SECRET,
-        "x-api-version": "2022-09-01"
-    }
     payload = {
         "order_id": order_id,
         "order_amount": amount,
@@ -73,8 +88,7 @@ async def create_cashfree_order(order_id: str, amount: float, email: str, phone:
         }
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(url, headers=headers, json=payload)
+    resp = await cashfree_client().post("/orders", json=payload)
 
     if resp.status_code == 200:
         return resp.json()
@@ -82,15 +96,7 @@ async def create_cashfree_order(order_id: str, amount: float, email: str, phone:
         raise Exception(f"Cashfree error: {resp.text}")
 
 async def verify_cashfree_payment(order_id: str):
-    url = f"{CASHFREE_BASE_URL}/orders/{order_id}"
-    headers = {
-        "x-client-id": CASHFREE_CLIENT_ID,
-        "x-client-secret": CASHFREE_CLIENT_SECRET,
-        "x-api-version": "2022-09-01"
-    }
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.get(url, headers=headers)
+    resp = await cashfree_client().get(f"/orders/{order_id}")
 
     if resp.status_code == 200:
         return resp.json()